@@ -1,2 +1,3 @@
 from turtlestats.stats import StatsHolder
-from turtlestats.gameplay import display_stats_in_game
\ No newline at end of file
+from turtlestats.gameplay import display_stats_in_game
+from turtlestats.telemetry import TelemetryRecorder
\ No newline at end of file
@@ -10,6 +10,10 @@ from turtle import Screen
 # third-party packages
 import pandas as pd
 import matplotlib.pyplot as plt
+# turtlestats
+from turtlestats.query import Query, BASE_COLUMNS
+from turtlestats.stats import migrate_stats_table, CREATE_INDEXES
+from turtlestats.utils import adapt_day, convert_day
 
 FIRST_UNIX_DAY = str(datetime.date(1970, 1, 1))
 
@@ -23,30 +27,48 @@ def get_dbname(code_dir: str = None):
     return dbname
 
 
-def get_rows(code_dir, query = "SELECT * FROM stats", params=None):
+def connect(code_dir) -> sqlite3.Connection:
+    '''connect to the database in code_dir, migrating it to
+    the integer timestamp layout first if need be'''
     dbname = get_dbname(code_dir)
-    with sqlite3.connect(dbname) as con:
+    con = sqlite3.connect(dbname)
+    if migrate_stats_table(con):
+        con.commit()
+        con.executescript(CREATE_INDEXES)
+    return con
+
+
+def get_rows(code_dir, query = "SELECT * FROM stats", params=None):
+    with connect(code_dir) as con:
         return pd.read_sql(query, con, params=params)
 
 
+def get_stats(code_dir) -> list[str]:
+    '''names of the stats in the database'''
+    with connect(code_dir) as con:
+        columns = con.execute("PRAGMA table_info(stats)").fetchall()
+    con.close()
+    return [col[1] for col in columns if col[1] not in BASE_COLUMNS]
+
+
 def best_score_bar(stat: str, 
                          first_day: datetime.date = None,
                          code_dir: str = None,
                          img_name: str = None):
     '''plot the trend of best scores by day'''
-    if first_day is None:
-        first_day = FIRST_UNIX_DAY
-    df = get_rows(code_dir,
-        f'''
-SELECT date, mx FROM 
-    (SELECT date, MAX({stat}) mx 
-    FROM stats GROUP BY date)
-WHERE date > ?
-ORDER BY date''',
-    (first_day,)
-    )
+    # this usually covers most of the table, so scanning it is faster
+    # than going through the day index (see tests/benchmark.py)
+    query = Query(get_stats(code_dir)).scan()
+    if first_day is not None:
+        query = query.where('day', '>', adapt_day(first_day))
+    query = (query
+        .group_by('day')
+        .aggregate('MAX', stat, 'mx')
+        .order_by('day', desc=False))
+    df = get_rows(code_dir, *query.compile())
     if not len(df):
         return
+    df['date'] = df['day'].map(convert_day)
     fig, ax = plt.subplots()
     df.plot.bar(x='date', y='mx', ax=ax, legend=None)
     plt.xlabel("Date")
@@ -64,15 +86,12 @@ def top_users_bar(stat: str,
               code_dir: str = None,
               img_name: str = None):
     '''bar plot of top users by stat'''
-    df = get_rows(code_dir, f'''
-SELECT * FROM
-    (SELECT username, MAX({stat}) mx 
-    FROM stats GROUP BY username)
-ORDER BY mx DESC
-LIMIT ?
-    ''',
-    (num_top_users,)
-    )
+    query = (Query(get_stats(code_dir))
+        .group_by('username')
+        .aggregate('MAX', stat, 'mx')
+        .order_by('mx')
+        .limit(num_top_users))
+    df = get_rows(code_dir, *query.compile())
     num_top_users = min(num_top_users, len(df))
     if num_top_users == 0:
         return
@@ -116,8 +135,7 @@ def turtle_plot_maker():
         except ValueError as ex:
             print(f"{code_dir} is not a directory containing a turtlestats database")
             code_dir = ''
-    df = get_rows(code_dir)
-    stats = list(df.columns[~df.columns.isin(['date', 'username'])])
+    stats = get_stats(code_dir)
     stat = ''
     while True:
         stat = screen.textinput("Statistic to plot", "Enter a stat name")
@@ -147,7 +165,7 @@ def turtle_plot_maker():
             if want_see_err is not None:
                 traceback.print_exc(ex)
     elif plot_type == 'trend':
-        first_day = FIRST_UNIX_DAY
+        first_day = None
         while True:
             first_day = screen.textinput("Earliest day to get data for", "Enter a date in YYYY-MM-DD format, or Cancel to get all dates")
             if first_day is None:
@@ -181,8 +199,8 @@ if __name__ == '__main__':
         dest='num_top_users')
     parser.add_argument('--first_day', 
         nargs='?', 
-        help="If making a 'trend' plot, the earliest day to consider scores for",
-        default=FIRST_UNIX_DAY,
+        help="If making a 'trend' plot, the earliest day to consider scores for (default all days)",
+        default=None,
         dest = 'first_day')
     parser.add_argument('--dirname', 
         help="The name of the directory to read stats from (default current dir)", 
@@ -5,12 +5,33 @@ import datetime
 import functools
 from turtle import Turtle
 from turtlestats.stats import StatsHolder, function
+from turtlestats.telemetry import TelemetryRecorder
 
 today = datetime.date.today
 
+def profile_message(profile: dict, stat_of_interest: str,
+                    score_of_interest, previous_best) -> str:
+    '''a summary of a player's progress to add to end-of-game messages.
+profile: the player's profile after the game
+score_of_interest: the value of stat_of_interest in the game
+previous_best: the player's best stat_of_interest before the game
+    (None if they had never played)'''
+    msg = (f"\nGames played: {profile['games']}. "
+           f"Daily streak: {profile['current_streak']} "
+           f"(longest {profile['longest_streak']}).")
+    if (previous_best is not None and score_of_interest is not None
+            and score_of_interest > previous_best):
+        msg += f"\nYou beat your previous best by {score_of_interest - previous_best:g}!"
+    stat = profile['stats'].get(stat_of_interest)
+    if stat:
+        msg += (f"\nAverage {stat_of_interest} over your last "
+                f"{len(stat['recent'])} games: {stat['recent_mean']:g}")
+    return msg
+
 def display_stats_in_game(scoreboard: Turtle,
                           stats: dict[str, type],
-                          stat_of_interest: str = None) -> function:
+                          stat_of_interest: str = None,
+                          telemetry_interval: int = None) -> function:
     '''scoreboard: a Turtle that holds stats of interest.
 stats: a dict where the keys are names of stats (these must be names
     of attributes of the scoreboard) and each value is the type of a stat.
@@ -20,7 +41,15 @@ stat_of_interest: the name of the stat that you want to compare to past scores.
     If you don't want to do this, just leave it blank.
     If you do, the screen will show a message congratulating the user
     at the end of the game if they got a high score in that game
-    (e.g., best score of all time, best score so far today)'''
+    (e.g., best score of all time, best score so far today)
+telemetry_interval: if not None, record a time series of the numeric stats
+    during each game in the samples table (see turtlestats.telemetry),
+    taking a sample every telemetry_interval milliseconds.
+    If 0, the game must call scoreboard.telemetry.sample() itself
+    (e.g., once per frame).
+The scoreboard will also get a `profile` attribute with the player's
+    games played, streaks and progress (see StatsHolder.player),
+    which is updated at the end of each game.'''
     def wrapper(gameplay_function: function) -> None:
         @functools.wraps(gameplay_function)
         def outfunc(*args, **kwargs):
@@ -28,42 +57,69 @@ stat_of_interest: the name of the stat that you want to compare to past scores.
             scoreboard.best_score = 0
             scoreboard.best_score_username = "???"
             hldr = StatsHolder(stats, scoreboard)
-            if stat_of_interest:
-                best_score_rows = hldr.top_by_stat(stat_of_interest, 1)
-                if best_score_rows:
-                    best_score_row = best_score_rows[0]
-                    scoreboard.best_score_username = best_score_row['username']
-                    scoreboard.best_score = best_score_row[stat_of_interest]
-            username = ""
-            while username == "":
-                username = screen.textinput("User name", "Enter user name")
-                screen.listen()
-                if username is None:
-                    username = "Anon"
-            gameplay_function(*args, **kwargs)
-            best_score_for_user_rows = hldr.top_by_stat_by_user(username, 
-                stat_of_interest)
-            best_score_today_rows = hldr.top_by_stat_on_date(today(), stat_of_interest)
-            hldr.store(username)
-            if stat_of_interest:
-                score_of_interest = getattr(scoreboard, stat_of_interest)
-                if score_of_interest > scoreboard.best_score:
-                    screen.textinput("HIGH SCORE!!!", 
-                        "Congratulations! You got the highest score ever!")
-                    return
-                best_score_for_user = float('inf')
-                if best_score_for_user_rows:
-                    best_score_for_user = best_score_for_user_rows[0][stat_of_interest]
-                if score_of_interest > best_score_for_user:
-                    screen.textinput("Personal high score",
-                        "This is your best score yet!")
-                    return
-                best_score_today = float('inf')
-                if best_score_today_rows:
-                    best_score_today = best_score_today_rows[0][stat_of_interest]
-                if score_of_interest > best_score_today:
-                    screen.textinput("Best score of the day!",
-                        "Congratulations! This is the top score so far today!")
+            scoreboard.telemetry = None
+            try:
+                if telemetry_interval is not None:
+                    scoreboard.telemetry = TelemetryRecorder(hldr,
+                        interval=telemetry_interval or None)
+                if stat_of_interest:
+                    best_score_rows = hldr.top_by_stat(stat_of_interest, 1)
+                    if best_score_rows:
+                        best_score_row = best_score_rows[0]
+                        scoreboard.best_score_username = best_score_row['username']
+                        scoreboard.best_score = best_score_row[stat_of_interest]
+                username = ""
+                while username == "":
+                    username = screen.textinput("User name", "Enter user name")
+                    screen.listen()
+                    if username is None:
+                        username = "Anon"
+                scoreboard.profile = hldr.player(username)
+                if scoreboard.telemetry is not None:
+                    scoreboard.telemetry.start()
+                gameplay_function(*args, **kwargs)
+                best_score_for_user_rows = best_score_today_rows = []
+                if stat_of_interest:
+                    best_score_for_user_rows = hldr.top_by_stat_by_user(username, 
+                        stat_of_interest)
+                    best_score_today_rows = hldr.top_by_stat_on_date(today(), stat_of_interest)
+                stats_id = hldr.store(username)
+                if scoreboard.telemetry is not None:
+                    scoreboard.telemetry.finish(stats_id)
+                previous_best = None
+                if stat_of_interest and scoreboard.profile is not None:
+                    previous_stat = scoreboard.profile['stats'].get(stat_of_interest)
+                    if previous_stat:
+                        previous_best = previous_stat['best']
+                scoreboard.profile = hldr.player(username)
+                if stat_of_interest:
+                    score_of_interest = getattr(scoreboard, stat_of_interest)
+                    progress = profile_message(scoreboard.profile, stat_of_interest,
+                        score_of_interest, previous_best)
+                    if score_of_interest > scoreboard.best_score:
+                        screen.textinput("HIGH SCORE!!!", 
+                            "Congratulations! You got the highest score ever!" + progress)
+                        return
+                    best_score_for_user = float('inf')
+                    if best_score_for_user_rows:
+                        best_score_for_user = best_score_for_user_rows[0][stat_of_interest]
+                    if score_of_interest > best_score_for_user:
+                        screen.textinput("Personal high score",
+                            "This is your best score yet!" + progress)
+                        return
+                    best_score_today = float('inf')
+                    if best_score_today_rows:
+                        best_score_today = best_score_today_rows[0][stat_of_interest]
+                    if score_of_interest > best_score_today:
+                        screen.textinput("Best score of the day!",
+                            "Congratulations! This is the top score so far today!" + progress)
+            finally:
+                # the game can raise, or the window can be closed
+                # (turtle.Terminator), before it's over
+                if scoreboard.telemetry is not None:
+                    scoreboard.telemetry.stop()
+                    scoreboard.telemetry.close()
+                hldr.close()
 
         return outfunc
     
@@ -0,0 +1,178 @@
+'''
+Keeps running totals, streaks and recent games for each player,
+updated in constant time every time a game is stored.
+'''
+import datetime
+import math
+import sqlite3
+from array import array
+from typing import Optional
+
+from turtlestats.utils import adapt_day
+
+# weight of the newest game in the exponentially weighted moving average
+EWMA_ALPHA = 0.2
+# number of games in the window of recent games
+RECENT_GAMES = 10
+
+CREATE_PROFILE_TABLES = '''
+CREATE TABLE IF NOT EXISTS players (
+    username TEXT PRIMARY KEY,
+    games INT,
+    first_day INT,
+    last_day INT,
+    current_streak INT,
+    longest_streak INT
+);
+CREATE TABLE IF NOT EXISTS player_stats (
+    username TEXT,
+    stat TEXT,
+    count INT,
+    total REAL,
+    total_sq REAL,
+    ewma REAL,
+    best REAL,
+    previous_best REAL,
+    recent BLOB,
+    PRIMARY KEY (username, stat)
+);
+'''
+
+INSERT_PLAYER = "INSERT OR REPLACE INTO players VALUES (?, ?, ?, ?, ?, ?)"
+INSERT_PLAYER_STAT = "INSERT OR REPLACE INTO player_stats VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+
+
+def make_profile_tables(con: sqlite3.Connection) -> bool:
+    '''Create the players and player_stats tables if they don't exist.
+    Returns True if they were just created.'''
+    exists = con.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'players'"
+    ).fetchone()
+    con.executescript(CREATE_PROFILE_TABLES)
+    return exists is None
+
+
+def update_player(player: Optional[tuple], username: str, day: int) -> tuple:
+    '''the players row for username after a game on day,
+    given their players row before the game (None if it's their first game)'''
+    if player is None:
+        return (username, 1, day, day, 1, 1)
+    _, games, first_day, last_day, current_streak, longest_streak = player
+    if day == last_day + 1:
+        current_streak += 1
+    elif day != last_day:
+        # a day was skipped (or the clock went backwards)
+        current_streak = 1
+    return (username, games + 1, first_day, max(day, last_day),
+            current_streak, max(current_streak, longest_streak))
+
+
+def update_player_stat(stat_row: Optional[tuple], username: str,
+                       statname: str, value: float) -> tuple:
+    '''the player_stats row for username and statname after a game
+    where statname was value, given the row before the game
+    (None if it's their first game)'''
+    if stat_row is None:
+        recent = array('d', [value])
+        return (username, statname, 1, value, value * value, value,
+                value, None, recent.tobytes())
+    _, _, count, total, total_sq, ewma, best, previous_best, recent_bytes = stat_row
+    ewma = EWMA_ALPHA * value + (1 - EWMA_ALPHA) * ewma
+    if value > best:
+        previous_best = best
+        best = value
+    recent = array('d')
+    recent.frombytes(recent_bytes)
+    recent.append(value)
+    if len(recent) > RECENT_GAMES:
+        del recent[0]
+    return (username, statname, count + 1, total + value,
+            total_sq + value * value, ewma, best, previous_best,
+            recent.tobytes())
+
+
+def store_profile(con: sqlite3.Connection, username: str, day: int,
+                  values: dict[str, float]) -> None:
+    '''update username's rows in the players and player_stats tables
+    after a game on day where each stat in values had that value'''
+    player = con.execute(
+        "SELECT * FROM players WHERE username = ?", (username,)
+    ).fetchone()
+    con.execute(INSERT_PLAYER, update_player(player, username, day))
+    stat_rows = {row[1]: row for row in con.execute(
+        "SELECT * FROM player_stats WHERE username = ?", (username,)
+    )}
+    con.executemany(INSERT_PLAYER_STAT, [
+        update_player_stat(stat_rows.get(statname), username, statname, value)
+        for statname, value in values.items()
+        if value is not None
+    ])
+
+
+def rebuild_profiles(con: sqlite3.Connection, statnames: list[str]) -> None:
+    '''Throw away the players and player_stats tables and recompute them
+    by replaying every game in the stats table in order.'''
+    players = {}
+    stat_rows = {}
+    cols = ", ".join(['username', 'day'] + list(statnames))
+    for row in con.execute(f"SELECT {cols} FROM stats ORDER BY timestamp, id"):
+        username, day = row[0], row[1]
+        players[username] = update_player(players.get(username), username, day)
+        for statname, value in zip(statnames, row[2:]):
+            if value is None:
+                continue
+            key = (username, statname)
+            stat_rows[key] = update_player_stat(stat_rows.get(key),
+                username, statname, value)
+    con.execute("DELETE FROM players")
+    con.execute("DELETE FROM player_stats")
+    con.executemany(INSERT_PLAYER, players.values())
+    con.executemany(INSERT_PLAYER_STAT, stat_rows.values())
+
+
+def summarize(player: sqlite3.Row, stat_rows: list[sqlite3.Row],
+              today: int = None) -> dict:
+    '''Turn a player's rows in the players and player_stats tables
+    into a dict like
+    {'username': 'mjo', 'games': 12, 'current_streak': 2, 'longest_streak': 5,
+     'stats': {'score': {'count': 12, 'mean': 40.5, 'std': 3.2, 'ewma': 42.1,
+        'best': 50, 'improvement': 4, 'recent': [...], 'recent_mean': 43.0}}}
+    improvement is how much the latest personal best beat the one before it
+    (None if there's only ever been one personal best).
+    current_streak is 0 if the player's last game was before yesterday,
+    because the stored streak is only reset when they play again.
+    today is a day number (see turtlestats.utils.adapt_day),
+    by default the current local day.'''
+    if today is None:
+        today = adapt_day(datetime.date.today())
+    current_streak = player['current_streak']
+    if player['last_day'] < today - 1:
+        current_streak = 0
+    out = {
+        'username': player['username'],
+        'games': player['games'],
+        'first_day': player['first_day'],
+        'last_day': player['last_day'],
+        'current_streak': current_streak,
+        'longest_streak': player['longest_streak'],
+        'stats': {},
+    }
+    for row in stat_rows:
+        count = row['count']
+        mean = row['total'] / count
+        # clamp rounding error that can make the variance slightly negative
+        variance = max(row['total_sq'] / count - mean * mean, 0.0)
+        recent = array('d')
+        recent.frombytes(row['recent'])
+        previous_best = row['previous_best']
+        out['stats'][row['stat']] = {
+            'count': count,
+            'mean': mean,
+            'std': math.sqrt(variance),
+            'ewma': row['ewma'],
+            'best': row['best'],
+            'improvement': None if previous_best is None else row['best'] - previous_best,
+            'recent': recent.tolist(),
+            'recent_mean': sum(recent) / len(recent),
+        }
+    return out
@@ -0,0 +1,225 @@
+'''
+Builds parameterized SQL queries on the stats table.
+'''
+import datetime
+import functools
+import re
+from typing import Iterable, Union
+
+from turtlestats.utils import adapt_day, adapt_timestamp
+
+BASE_COLUMNS = ('id', 'username', 'timestamp', 'day')
+OPERATORS = ('=', '!=', '<', '<=', '>', '>=')
+AGGREGATES = ('MAX', 'MIN', 'AVG', 'SUM', 'COUNT')
+
+
+@functools.lru_cache(maxsize=256)
+def compile_select(table: str,
+                   select: tuple[str, ...],
+                   where: tuple[tuple[str, str], ...],
+                   group_by: tuple[str, ...],
+                   order_by: tuple[tuple[str, bool], ...],
+                   has_limit: bool) -> str:
+    '''
+Make the text of a SELECT statement from the structure of a Query.
+Only the structure goes into the text; every value is a ? parameter,
+so the same structure always gives the same text (and sqlite3 can reuse
+its prepared statement for it).
+This is memoized, so each structure is only compiled once.
+EXAMPLES
+___________
+compile_select('stats', ('*',), (('username', '='), ('day', '>=')), (), (('score', True),), True)
+returns 'SELECT * FROM stats WHERE username = ? AND day >= ? ORDER BY score DESC LIMIT ?'
+    '''
+    query = f"SELECT {', '.join(select)} FROM {table}"
+    if where:
+        query += " WHERE " + " AND ".join(f"{col} {op} ?" for col, op in where)
+    if group_by:
+        query += " GROUP BY " + ", ".join(group_by)
+    if order_by:
+        query += " ORDER BY " + ", ".join(
+            f"{col} DESC" if desc else col for col, desc in order_by)
+    if has_limit:
+        query += " LIMIT ?"
+    return query
+
+
+class Query:
+    """A composable query on the stats table of a StatsHolder.
+
+    Every method returns a new Query, so a Query can be reused as
+    the base of several other queries. Column names are checked against
+    the id, username, timestamp, day and declared stats, and every value
+    is passed as a parameter, so no user input ever goes into the SQL.
+
+    EXAMPLES
+    ___________
+    hldr.query().by_user('mjo').where('score', '>=', 10).order_by('score').limit(5).fetch()
+    gets mjo's 5 best games with a score of at least 10.
+    hldr.query().between(first_day, last_day).group_by('username').aggregate('MAX', 'score').fetch()
+    gets each user's best score from first_day to last_day.
+    hldr.query().on_date(today).top_values(['score', 'distance'])
+    gets today's best score and best distance.
+    """
+    _holder: 'StatsHolder'
+    _stats: tuple[str, ...]
+    _select: tuple[str, ...]
+    _aliases: tuple[str, ...]
+    _where: tuple[tuple[str, str], ...]
+    _params: tuple
+    _group_by: tuple[str, ...]
+    _order_by: tuple[tuple[str, bool], ...]
+    _limit: int
+    _scan: bool
+
+    def __init__(self, stats: Iterable[str], holder: 'StatsHolder' = None):
+        '''stats: the names of the stats in the stats table
+holder: the StatsHolder that fetch() and top_values() get rows from.
+    Without one, you can still compile() the query and execute it yourself.'''
+        self._holder = holder
+        self._stats = tuple(stats)
+        self._select = ()
+        self._aliases = ()
+        self._where = ()
+        self._params = ()
+        self._group_by = ()
+        self._order_by = ()
+        self._limit = None
+        self._scan = False
+
+    def _copy(self, **changes) -> 'Query':
+        out = object.__new__(Query)
+        out.__dict__.update(self.__dict__)
+        out.__dict__.update(changes)
+        return out
+
+    def _check_column(self, column: str) -> str:
+        if column not in BASE_COLUMNS and column not in self._stats:
+            raise ValueError(f"{column!r} is not a column of the stats table. Columns are {BASE_COLUMNS + self._stats}")
+        return column
+
+    def _check_stat(self, statname: str) -> str:
+        if statname not in self._stats:
+            raise ValueError(f"{statname!r} is not one of the stats {self._stats}")
+        return statname
+
+    def select(self, *columns: str) -> 'Query':
+        '''only get these columns (by default, get all columns)'''
+        for column in columns:
+            self._check_column(column)
+        return self._copy(_select=self._select + columns)
+
+    def aggregate(self, func: str, statname: str, alias: str = None) -> 'Query':
+        '''get func (one of MAX, MIN, AVG, SUM or COUNT) of statname,
+        named alias (by default, "{func}_{statname}" in lowercase).
+        Use with group_by to get one value per group.'''
+        func = func.upper()
+        if func not in AGGREGATES:
+            raise ValueError(f"func must be one of {AGGREGATES}")
+        self._check_stat(statname)
+        if alias is None:
+            alias = f"{func.lower()}_{statname}"
+        elif not re.fullmatch(r"[A-Za-z_]\w*", alias):
+            raise ValueError(f"{alias!r} is not a valid alias")
+        return self._copy(_select=self._select + (f"{func}({statname}) AS {alias}",),
+                          _aliases=self._aliases + (alias,))
+
+    def where(self, column: str, op: str, value) -> 'Query':
+        '''only get rows where `column op value` is true,
+        e.g. where('score', '>=', 10).
+        Dates and datetimes (or ISO format strings like '2022-09-11' or
+        '2022-09-11 08:30') compared to the day or timestamp columns are
+        converted to those columns' integer formats (a date compared to
+        timestamp means local midnight at the start of that date).'''
+        self._check_column(column)
+        if op not in OPERATORS:
+            raise ValueError(f"op must be one of {OPERATORS}")
+        if column == 'day':
+            if isinstance(value, (datetime.date, str)):
+                value = adapt_day(value)
+            elif not isinstance(value, int):
+                raise TypeError("day can only be compared to a date, an ISO format date string or an int (days since 1970-01-01)")
+        elif column == 'timestamp':
+            if isinstance(value, str):
+                value = datetime.datetime.fromisoformat(value)
+            if isinstance(value, datetime.datetime):
+                value = adapt_timestamp(value)
+            elif isinstance(value, datetime.date):
+                value = adapt_timestamp(datetime.datetime.combine(value, datetime.time()))
+            elif not isinstance(value, int):
+                raise TypeError("timestamp can only be compared to a datetime, a date, an ISO format string or an int (milliseconds since the Unix epoch)")
+        return self._copy(_where=self._where + ((column, op),),
+                          _params=self._params + (value,))
+
+    def by_user(self, username: str) -> 'Query':
+        '''only get rows for username'''
+        return self.where('username', '=', username)
+
+    def on_date(self, date: Union[datetime.date, str]) -> 'Query':
+        '''only get rows on date (a date or a YYYY-MM-DD string)'''
+        return self.where('day', '=', date)
+
+    def between(self,
+                start: Union[datetime.date, datetime.datetime],
+                end: Union[datetime.date, datetime.datetime]) -> 'Query':
+        '''only get rows from start to end (inclusive).
+        If start and end are dates, compare them to the day column.
+        If they are datetimes, compare them to the timestamp column.'''
+        start_is_dt = isinstance(start, datetime.datetime)
+        if start_is_dt != isinstance(end, datetime.datetime):
+            raise TypeError("start and end must both be dates or both be datetimes")
+        if start_is_dt:
+            return (self.where('timestamp', '>=', start)
+                        .where('timestamp', '<=', end))
+        return (self.where('day', '>=', start)
+                    .where('day', '<=', end))
+
+    def group_by(self, *columns: str) -> 'Query':
+        '''get one row for each distinct combination of columns.
+        The columns are also selected.'''
+        for column in columns:
+            self._check_column(column)
+        return self._copy(_select=self._select + columns,
+                          _group_by=self._group_by + columns)
+
+    def order_by(self, column: str, desc: bool = True) -> 'Query':
+        '''sort by column (a column or the alias of an aggregate),
+        in descending order by default'''
+        if column not in self._aliases:
+            self._check_column(column)
+        return self._copy(_order_by=self._order_by + ((column, desc),))
+
+    def limit(self, num_rows: int) -> 'Query':
+        '''get at most num_rows rows'''
+        return self._copy(_limit=num_rows)
+
+    def scan(self) -> 'Query':
+        '''read the whole table instead of using the day or timestamp index.
+        This is faster for queries that match most of the rows
+        (e.g., grouping every day's games by day), since going through
+        an index means looking up each matching row separately.'''
+        return self._copy(_scan=True)
+
+    def compile(self) -> tuple[str, tuple]:
+        '''the text of the query and its parameters'''
+        table = 'stats NOT INDEXED' if self._scan else 'stats'
+        query = compile_select(table, self._select or ('*',), self._where,
+                               self._group_by, self._order_by,
+                               self._limit is not None)
+        if self._limit is None:
+            return query, self._params
+        return query, self._params + (self._limit,)
+
+    def fetch(self) -> list:
+        '''all rows matching this query'''
+        return self._holder.fetch(*self.compile())
+
+    def top_values(self, statnames: Iterable[str]) -> dict[str, object]:
+        '''the highest value of each stat in statnames,
+        found in one scan of the rows matching this query'''
+        statnames = tuple(statnames)
+        query = self
+        for statname in statnames:
+            query = query.aggregate('MAX', statname, statname)
+        rows = query.fetch()
+        return {statname: rows[0][statname] for statname in statnames}
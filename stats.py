@@ -9,40 +9,66 @@ import sqlite3
 from typing import Union
 from turtle import Turtle
 
-from turtlestats.utils import sqlite_typename
+from turtlestats import profiles
+from turtlestats.query import Query
+from turtlestats.utils import sqlite_typename, now_timestamp, adapt_day, day_of_timestamp
 
 function = type(lambda x: x)
 
-def setup_db_dir(scoreboard: Turtle) -> tuple[str, bool]:
+def setup_db_dir(scoreboard: Turtle, code_dir: str = None) -> tuple[str, bool]:
     '''
-    Creates a ".turtlestats" directory in the source
-    directory of a scoreboard (turtle object)
+    Creates a ".turtlestats" directory in code_dir, or by default in the
+    source directory of a scoreboard (turtle object)
     Returns the directory name, and bool(the directory already existed)
     '''
-
-    src_fname = inspect.getabsfile(scoreboard.__class__)
-    src_dir = os.path.dirname(src_fname)
+    if code_dir is None:
+        src_fname = inspect.getabsfile(scoreboard.__class__)
+        src_dir = os.path.dirname(src_fname)
+    else:
+        src_dir = code_dir
     stats_dir = os.path.join(src_dir, ".turtlestats")
     if not os.path.exists(stats_dir):
         os.mkdir(stats_dir)
         return stats_dir, True
     return stats_dir, False
 
-CREATE_TABLE_BASE = "CREATE TABLE stats (\n    username TEXT,\n    date TEXT,"
+CREATE_TABLE_BASE = "CREATE TABLE stats (\n    id INTEGER PRIMARY KEY,\n    username TEXT,\n    timestamp INT,\n    day INT,"
+
+CREATE_INDEXES = '''
+CREATE INDEX IF NOT EXISTS stats_day ON stats (day);
+CREATE INDEX IF NOT EXISTS stats_timestamp ON stats (timestamp);
+'''
+
+MIGRATE_STATS = '''
+INSERT INTO stats_new (id, username, timestamp, day{cols})
+SELECT rowid, username, {timestamp}, {day}{cols}
+FROM stats;
+DROP TABLE stats;
+ALTER TABLE stats_new RENAME TO stats;
+'''
+
+# the oldest layout stored the date as YYYY-MM-DD TEXT with no time of day.
+# Those rows get a timestamp of local midnight on that date.
+TEXT_DATE_TIMESTAMP = "CAST(strftime('%s', date, 'utc') AS INTEGER) * 1000"
+TEXT_DATE_DAY = "CAST(julianday(date) - julianday('1970-01-01') AS INTEGER)"
 
 def make_stats_db(stats: dict[str, type], dbname: str) -> None:
     '''
 stats: a dict mapping names of scoreboard stats (e.g., score, distance
     traveled to the type of that stat)
 
-If the database dbname exists, do nothing.
+If the database dbname exists, migrate it to the current layout
+    if it uses an older one (see migrate_stats_table).
 If the database dbname doesn't exist, 
     execute a SQLite CREATE TABLE statement that makes a table with columns
-    for the desired stats as well as the username and the date.
+    for the desired stats as well as an id, the username, the timestamp
+    (integer milliseconds since the Unix epoch),
+    and the day (integer days since 1970-01-01).
+Either way, make sure the day and timestamp columns are indexed.
 EXAMPLES
 ___________
 make_stats_db({"winner": bool, "left_score": float, "right_score": float})
-executes the query 'CREATE TABLE stats (\n    username TEXT,\n    date TEXT,\n    winner INT,\n    left_score REAL,\n    right_score REAL\n);'
+executes the query 'CREATE TABLE stats (\n    id INTEGER PRIMARY KEY,\n    username TEXT,\n    timestamp INT,\n    day INT,\n    winner INT,\n    left_score REAL,\n    right_score REAL\n);'
     '''
     dbdef = CREATE_TABLE_BASE
     ii = 0
@@ -54,29 +80,78 @@ executes the query 'CREATE TABLE stats (\n    username TEXT,\n    date TEXT,\n
             dbdef += ','
     dbdef += '\n);'
     # print(dbdef)
-    if not os.path.exists(dbname):
-        con = sqlite3.connect(dbname)
-        try:
+    exists = os.path.exists(dbname)
+    con = sqlite3.connect(dbname)
+    try:
+        if not exists:
             con.executescript(dbdef)
-        except Exception as ex:
-            con.rollback()
-            raise ex
         else:
-            con.commit()
-        finally:
-            con.close()
+            migrate_stats_table(con)
+        con.executescript(CREATE_INDEXES)
+    except Exception as ex:
+        con.rollback()
+        raise ex
+    else:
+        con.commit()
+    finally:
+        con.close()
+
+
+def migrate_stats_table(con: sqlite3.Connection) -> bool:
+    '''If the stats table in con uses an older layout, rebuild it
+with the current one, keeping every stat column as is:
+- a TEXT date column (the layout used before turtlestats 0.5.0)
+    is replaced with integer timestamp and day columns.
+- rows get an explicit id INTEGER PRIMARY KEY equal to their old rowid,
+    so ids (which the samples table refers to) never change on VACUUM.
+Returns True if the table was migrated.'''
+    columns = con.execute("PRAGMA table_info(stats)").fetchall()
+    colnames = [col[1] for col in columns]
+    if 'id' in colnames:
+        return False
+    if 'date' in colnames:
+        timestamp, day = TEXT_DATE_TIMESTAMP, TEXT_DATE_DAY
+    else:
+        timestamp, day = 'timestamp', 'day'
+    dbdef = CREATE_TABLE_BASE.replace('stats', 'stats_new', 1)
+    other_cols = ''
+    for _, colname, typename, *_ in columns:
+        if colname in ('username', 'date', 'timestamp', 'day'):
+            continue
+        dbdef += f'\n    {colname} {typename},'
+        other_cols += f', {colname}'
+    dbdef = dbdef.rstrip(',') + '\n);'
+    # executescript would commit before running, so execute one at a time
+    # to keep the whole migration in a single transaction
+    con.execute("BEGIN")
+    con.execute(dbdef)
+    migration = MIGRATE_STATS.format(cols=other_cols, timestamp=timestamp, day=day)
+    for statement in migration.split(';'):
+        if statement.strip():
+            con.execute(statement)
+    return True
+
+
+# number of prepared statements sqlite3 keeps per connection.
+# Query compiles each query structure to the same text every time,
+# so this only needs to hold one statement per structure in use.
+CACHED_STATEMENTS = 256
 
 
 def with_connection(meth):
-    """Connect to the database at the file path of a StatsHolder's dbname,
-    try to perform the method's function, commit if successful,
-    clean up if there's an error, and finally close the database."""
+    """Connect to the database at the file path of a StatsHolder's dbname
+    if it isn't connected already, try to perform the method's function,
+    commit if successful, and roll back if there's an error.
+    The connection stays open until the holder's close() method is called,
+    so sqlite3's cache of prepared statements is kept between calls."""
 
     @functools.wraps(meth)
     def wrapper(*args, **kwargs):
         holder = args[0]
-        holder.con = sqlite3.connect(holder.dbname)
-        holder.con.row_factory = sqlite3.Row
+        if holder.con is None:
+            holder.con = sqlite3.connect(holder.dbname,
+                cached_statements=CACHED_STATEMENTS)
+            holder.con.row_factory = sqlite3.Row
         try:
             out = meth(*args, **kwargs)
         except Exception as ex:
@@ -86,16 +161,23 @@ def with_connection(meth):
             # print(f'commited transaction from method {meth} with args {args} and kwargs {kwargs}')
             holder.con.commit()
             return out
-        finally:
-            holder.con.close()
-            holder.con = None
 
     return wrapper
 
 
+def close_connection(holder) -> None:
+    """Close the connection opened by with_connection, if there is one."""
+    if holder.con is not None:
+        holder.con.close()
+        holder.con = None
+
+
 class StatsHolder:
-    """A wrapper around a SQLite database containing usernames, dates,
-    and various stats.
+    """A wrapper around a SQLite database containing usernames, timestamps,
+    days, and various stats.
+
+    Timestamps are stored as integer milliseconds since the Unix epoch,
+    and days as integer days since 1970-01-01 (see turtlestats.utils).
 
     Contains functions for getting rows that have top stats.
     """
@@ -104,11 +186,17 @@ class StatsHolder:
     con: sqlite3.Connection
     _scoreboard: Turtle
     _stats: dict[str, type]
+    _profile_stats: list[str]
     
     def __init__(self,
                  stats: dict[str, type], 
-                 scoreboard: Turtle):
-        dirname, _ = setup_db_dir(scoreboard)
+                 scoreboard: Turtle,
+                 code_dir: str = None):
+        '''stats: a dict mapping names of scoreboard stats to their types
+scoreboard: a Turtle whose attributes include each stat
+code_dir: the directory to put the .turtlestats directory in.
+    By default, the directory of the source file of the scoreboard's class.'''
+        dirname, _ = setup_db_dir(scoreboard, code_dir)
         # print(dirname)
         self.dbname = os.path.join(dirname, "stats.sqlite")
         # print(self.dbname)
@@ -120,105 +208,147 @@ class StatsHolder:
             except:
                 raise ValueError("Each key in the stats dictionary must be the name of an attribute of the scoreboard.")
         make_stats_db(stats, self.dbname)
-        self.con = None  # filled in when calling with_connection methods
+        self.con = None  # opened by the first with_connection method
+        # players' running totals only make sense for numeric stats
+        self._profile_stats = [statname for statname, typ in stats.items()
+                               if not issubclass(typ, str)]
+        self._setup_profiles()
         # create the database if there isn't one already.
         # add an index on filenames to speed searches.
-        num_vals = 2 + len(self._stats)
-        colnames = "(username, date, " + ", ".join(self._stats) + ")"
+        num_vals = 3 + len(self._stats)
+        colnames = "(username, timestamp, day, " + ", ".join(self._stats) + ")"
         questionmarks = ", ".join("?" for ii in range(num_vals))
         self.insert_query = f"INSERT INTO stats {colnames} VALUES ({questionmarks})"
         # yeah, it sucks to be using f-strings in a SQL execute statement
         # but given that stats is a private variable and they have to be
-        # the names of attributes of the scoreboard, it's likely fine
+        # the names of attributes of the scoreboard, it's likely fine.
+        # Everything else goes through Query, which checks column names.
 
     @property
     def stats(self):
         return self._stats.copy()
 
+    def close(self) -> None:
+        '''close the connection to the database.
+        It's reopened by the next method that needs it.'''
+        close_connection(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @with_connection
+    def _setup_profiles(self) -> None:
+        # databases made before player profiles existed
+        # need their profiles built from the games they already have
+        if profiles.make_profile_tables(self.con):
+            profiles.rebuild_profiles(self.con, self._profile_stats)
+
+    @with_connection
+    def rebuild_profiles(self) -> None:
+        '''recompute every player's profile from scratch
+        from the rows of the stats table'''
+        profiles.rebuild_profiles(self.con, self._profile_stats)
+
+    @with_connection
+    def player(self, username: str) -> dict:
+        '''username's profile (see turtlestats.profiles.summarize):
+        games played, current and longest daily streaks,
+        and the count, mean, standard deviation, moving average,
+        personal best and recent games of each numeric stat.
+        None if username has never played.'''
+        player = self.con.execute(
+            "SELECT * FROM players WHERE username = ?", (username,)
+        ).fetchone()
+        if player is None:
+            return None
+        stat_rows = self.con.execute(
+            "SELECT * FROM player_stats WHERE username = ?", (username,)
+        ).fetchall()
+        return profiles.summarize(player, stat_rows)
+
     @with_connection
     def all(self) -> list:
         '''all rows from the database'''
         return self.con.execute("SELECT * FROM stats").fetchall()
 
+    def query(self) -> Query:
+        '''a Query on the stats table (see turtlestats.query)
+        that gets its rows from this database'''
+        return Query(self._stats, self)
+
     @with_connection
+    def fetch(self, query: str, params: tuple = ()) -> list:
+        '''all rows returned by a parameterized query'''
+        return self.con.execute(query, params).fetchall()
+
     def all_by_user(self, username: str) -> list:
         '''get all rows for a given username'''
-        return self.con.execute(
-            "SELECT * FROM stats WHERE username = ?", (username,)
-        ).fetchall()
+        return self.query().by_user(username).fetch()
     
-    @with_connection
     def all_on_date(self, date: datetime.date) -> list:
         '''get all rows on a given date'''
-        return self.con.execute(
-            "SELECT * FROM stats WHERE date = ?", (date,)
-        ).fetchall()
+        return self.query().on_date(date).fetch()
 
-    @with_connection
     def by_user_on_date(self, username: str, date: datetime.date) -> list:
         '''get all rows on a given date for a given username'''
-        return self.con.execute(
-            "SELECT * FROM stats WHERE username = ? AND date = ?", 
-            (username, date)
-        ).fetchall()
+        return self.query().by_user(username).on_date(date).fetch()
 
-    @with_connection
     def top_by_stat(self, statname: str, top: int = 1) -> list:
         '''get all rows with the all-time highest values of statname
         across all users'''
-        return self.con.execute(
-            f"SELECT * FROM stats ORDER BY {statname} DESC LIMIT ?", 
-            (top,)
-        ).fetchall()
+        return self.query().order_by(statname).limit(top).fetch()
+
+    def top_values(self, statnames: list[str]) -> dict:
+        '''the all-time highest value of each stat in statnames,
+        found in one scan of the table'''
+        return self.query().top_values(statnames)
 
-    @with_connection
     def top_by_stat_on_date(self, date: datetime.date, statname: str, top: int = 1) -> list:
         '''all rows with the top values of statname on a given date'''
-        return self.con.execute(
-            f"SELECT * FROM stats WHERE date = ? ORDER BY {statname} DESC LIMIT ?", 
-            (date, top)
-        ).fetchall()
+        return self.query().on_date(date).order_by(statname).limit(top).fetch()
 
-    @with_connection
     def top_by_stat_by_user(self, username: str, statname: str, top: int = 1) -> list:
         '''all rows with the top values of statname for a given username'''
-        return self.con.execute(
-            f"SELECT * FROM stats WHERE username = ? ORDER BY {statname} DESC LIMIT ?", 
-            (username, top)
-        ).fetchall()
+        return self.query().by_user(username).order_by(statname).limit(top).fetch()
     
-    @with_connection
     def top_by_stat_by_user_on_date(self, username: str, date: datetime.date, statname: str, top: int = 1) -> list:
         '''all rows with the top values of statname for a given username on a given date'''
-        return self.con.execute(
-            f"SELECT * FROM stats WHERE username = ? AND date = ? ORDER BY {statname} DESC LIMIT ?", 
-            (username, date, top)
-        ).fetchall()
+        return (self.query().by_user(username).on_date(date)
+                    .order_by(statname).limit(top).fetch())
 
-    @with_connection
     def first_per_date(self, statname: str, first_day: datetime.date) -> list:
         """the highest score and the person who got that score for each day
         since first_day"""
-        query = f'''
-SELECT mud.username, mud.date, mud.mx 
-FROM ( -- get max value per username by date
-    SELECT username, date, MAX({statname}) mx
-    FROM stats
-    WHERE date >= ?
-    GROUP BY username, date
-    ) mud 
-JOIN ( -- get highest overall score per day
-    SELECT date, MAX({statname}) mx
-    FROM stats
-    WHERE date >= ?
-    GROUP BY date
-    ) md
-WHERE mud.date = md.date AND mud.mx = md.mx
-ORDER BY mud.date
-LIMIT 1
-        '''
-        return self.con.execute(query, 
-            (first_day, first_day)
+        # SQLite takes the bare username column from the row with the MAX
+        return (self.query()
+            .where('day', '>=', adapt_day(first_day))
+            .select('username')
+            .group_by('day')
+            .aggregate('MAX', statname, 'mx')
+            .order_by('day', desc=False)
+            .limit(1)
+            .fetch())
+
+    def between(self,
+                start: Union[datetime.date, datetime.datetime],
+                end: Union[datetime.date, datetime.datetime]) -> list:
+        '''all rows from start to end (inclusive), in chronological order.
+        If start and end are dates, compare them to the day column.
+        If they are datetimes, compare them to the timestamp column.
+        Either way the query uses an index.'''
+        return self.query().between(start, end).order_by('timestamp', desc=False).fetch()
+
+    @with_connection
+    def samples(self, stats_id: int) -> list:
+        '''all telemetry samples (see turtlestats.telemetry) recorded
+        during the game stored in the row of stats with id stats_id,
+        in chronological order'''
+        return self.con.execute(
+            "SELECT * FROM samples WHERE stats_id = ? ORDER BY timestamp, rowid",
+            (stats_id,)
         ).fetchall()
 
     @with_connection
@@ -227,14 +357,22 @@ LIMIT 1
         return out.fetchall()
 
     @with_connection
-    def store(self, username: str) -> None:
+    def store(self, username: str) -> int:
         '''get the current values of each stat of interest from the
         scoreboard, and then add a new row to the database with
-        the username, today's date, and each stat.'''
-        today = datetime.date.today()
-        values = [username, today]
+        the username, the current timestamp and day, and each stat.
+        Also update the user's profile.
+        Returns the id of the new row.'''
+        timestamp = now_timestamp()
+        day = day_of_timestamp(timestamp)
+        values = [username, timestamp, day]
         for statname in self._stats:
             # get the current value of each stat from the scoreboard
             values.append(getattr(self._scoreboard, statname))
         # print(f"writing values {values}")
-        self.con.execute(self.insert_query, values)
+        # lastrowid is the id column, since it's an INTEGER PRIMARY KEY
+        stats_id = self.con.execute(self.insert_query, values).lastrowid
+        profile_values = {statname: getattr(self._scoreboard, statname)
+                          for statname in self._profile_stats}
+        profiles.store_profile(self.con, username, day, profile_values)
+        return stats_id
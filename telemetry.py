@@ -0,0 +1,241 @@
+'''
+Records time series of stats while a game is being played.
+'''
+import functools
+import secrets
+import sqlite3
+from array import array
+from turtle import Turtle
+
+from turtlestats.stats import StatsHolder, with_connection, close_connection
+from turtlestats.utils import sqlite_typename, now_timestamp
+
+# samples from a game that hasn't been linked to a row of stats
+# this long after its last sample was taken are assumed to be from a game
+# that crashed, and are deleted
+STALE_UNFINISHED_MS = 24 * 60 * 60 * 1000
+
+NAN = float('nan')
+
+
+def make_samples_table(stats: dict[str, type], dbname: str) -> None:
+    '''
+stats: a dict mapping names of numeric scoreboard stats to their types
+
+Create a samples table in the database dbname (if there isn't one already)
+    with columns for the id of the game's row in the stats table,
+    a random token identifying the game while it's being played,
+    the timestamp of each sample, and each stat.
+EXAMPLES
+___________
+make_samples_table({"score": int, "distance": float}, dbname)
+executes the query 'CREATE TABLE IF NOT EXISTS samples (\\n    stats_id INT,\\n    game INT,\\n    timestamp INT,\\n    score INT,\\n    distance REAL\\n);'
+    '''
+    dbdef = "CREATE TABLE IF NOT EXISTS samples (\n    stats_id INT,\n    game INT,\n    timestamp INT"
+    for statname, typ in stats.items():
+        dbdef += f',\n    {statname} {sqlite_typename(typ)}'
+    # unlinked samples are found through this index too (stats_id IS NULL),
+    # so game doesn't need its own index
+    dbdef += '\n);\nCREATE INDEX IF NOT EXISTS samples_stats_id ON samples (stats_id);'
+    con = sqlite3.connect(dbname)
+    try:
+        con.executescript(dbdef)
+    except Exception as ex:
+        con.rollback()
+        raise ex
+    else:
+        con.commit()
+    finally:
+        con.close()
+
+
+class TelemetryRecorder:
+    """Samples the numeric stats of a scoreboard many times per game.
+
+    Samples are written into preallocated arrays used as a ring buffer,
+    so taking a sample doesn't create any lists, tuples or rows,
+    and sample() never touches the database.
+    By default, nothing is written until finish() is called after the game,
+    and if a game takes more than `capacity` samples, the oldest ones are
+    overwritten so only the most recent `capacity` samples are kept.
+
+    If flush_when_full is True, every sample is kept: once the ring buffer
+    is half full, sample() schedules a flush with screen.ontimer, which
+    writes the buffer to the samples table in one batch the next time the
+    game's event loop is idle. That write still blocks the game while it
+    runs (several milliseconds for 1024 samples, more on a slow disk;
+    see tests/benchmark.py), so it can cost the game a frame.
+    The other half of the ring buffer holds the samples taken
+    before the flush runs.
+
+    Each game gets a random token when start() is called.
+    Samples are written with that token and a NULL stats_id until the game
+    ends, at which point finish(stats_id) links them to the game's row
+    in stats. The token keeps games being played at the same time on the
+    same database from claiming or deleting each other's samples.
+    """
+    dbname: str
+    con: sqlite3.Connection
+    capacity: int
+    interval: int
+    flush_when_full: bool
+    insert_query: str
+    _scoreboard: Turtle
+    _statnames: tuple[str, ...]
+    _timestamps: array
+    _values: array
+    _head: int
+    _pending: int
+    _flush_at: int
+    _flush_scheduled: bool
+    _timer_generation: int
+    _game: int
+
+    def __init__(self,
+                 holder: StatsHolder,
+                 capacity: int = 1024,
+                 interval: int = None,
+                 flush_when_full: bool = False):
+        '''holder: the StatsHolder for the scoreboard to sample
+capacity: the number of samples held in memory between writes to the database
+interval: milliseconds between samples. If None, the game must call
+    sample() itself (e.g., once per frame).
+flush_when_full: if True, write samples to the database while the game is
+    idle whenever the ring buffer is half full, instead of only keeping
+    the last `capacity` samples until finish(). Each of these writes
+    blocks the game for as long as it takes.'''
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        self.dbname = holder.dbname
+        self.con = None  # opened by the first with_connection method
+        self.capacity = capacity
+        self.interval = interval
+        self.flush_when_full = flush_when_full
+        self._scoreboard = holder._scoreboard
+        # strings can't go in an array of doubles, so only numeric stats
+        # are sampled
+        stats = {statname: typ for statname, typ in holder.stats.items()
+                 if not issubclass(typ, str)}
+        self._statnames = tuple(stats)
+        make_samples_table(stats, self.dbname)
+        self._timestamps = array('q', bytes(8 * capacity))
+        self._values = array('d', bytes(8 * capacity * len(stats)))
+        self._head = 0
+        self._pending = 0
+        self._flush_at = max(capacity // 2, 1)
+        self._flush_scheduled = False
+        # bumped by every start() and stop(), so that timer callbacks
+        # scheduled before then know to stop
+        self._timer_generation = 0
+        self._game = secrets.randbits(63)
+        colnames = "(" + ", ".join(('stats_id', 'game', 'timestamp') + self._statnames) + ")"
+        questionmarks = ", ".join("?" for ii in range(3 + len(stats)))
+        self.insert_query = f"INSERT INTO samples {colnames} VALUES ({questionmarks})"
+
+    def __len__(self):
+        '''the number of samples in the ring buffer'''
+        return self._pending
+
+    def sample(self) -> None:
+        '''record the current value of each numeric stat'''
+        head = self._head
+        self._timestamps[head] = now_timestamp()
+        width = len(self._statnames)
+        start = head * width
+        scoreboard = self._scoreboard
+        statnames = self._statnames
+        values = self._values
+        for ii in range(width):
+            value = getattr(scoreboard, statnames[ii])
+            # an array of doubles can't hold None, but it can hold NaN,
+            # which sqlite3 stores as NULL
+            values[start + ii] = NAN if value is None else value
+        head += 1
+        if head == self.capacity:
+            head = 0
+        self._head = head
+        if self._pending < self.capacity:
+            self._pending += 1
+        if (self.flush_when_full and self._pending >= self._flush_at
+                and not self._flush_scheduled):
+            # don't write on the game's frame; wait until it's idle
+            self._flush_scheduled = True
+            scoreboard.screen.ontimer(self._idle_flush, 0)
+
+    def _idle_flush(self) -> None:
+        self._flush_scheduled = False
+        self.flush()
+
+    def _tick(self, generation: int) -> None:
+        if generation != self._timer_generation:
+            return
+        self.sample()
+        self._scoreboard.screen.ontimer(
+            functools.partial(self._tick, generation), self.interval)
+
+    def start(self) -> None:
+        '''Start a new game: get a new token, empty the ring buffer,
+        delete any samples left over from games that crashed
+        (see STALE_UNFINISHED_MS), and start sampling every
+        `interval` milliseconds if interval is not None.'''
+        self._game = secrets.randbits(63)
+        self._head = 0
+        self._pending = 0
+        self._delete_stale()
+        self._timer_generation += 1
+        if self.interval is not None:
+            self._tick(self._timer_generation)
+
+    def stop(self) -> None:
+        '''stop sampling on a timer'''
+        self._timer_generation += 1
+
+    def close(self) -> None:
+        '''close the connection to the database.
+        It's reopened by the next flush.'''
+        close_connection(self)
+
+    @with_connection
+    def _delete_stale(self) -> None:
+        self.con.execute('''
+DELETE FROM samples WHERE stats_id IS NULL AND game IN (
+    SELECT game FROM samples
+    WHERE stats_id IS NULL
+    GROUP BY game
+    HAVING MAX(timestamp) < ?
+)''',
+            (now_timestamp() - STALE_UNFINISHED_MS,)
+        )
+
+    def _rows(self):
+        width = len(self._statnames)
+        values = self._values
+        timestamps = self._timestamps
+        first = self._head - self._pending
+        for ii in range(first, self._head):
+            # negative indices wrap around to the end of the ring buffer
+            idx = ii % self.capacity
+            yield (None, self._game, timestamps[idx],
+                   *values[idx * width:(idx + 1) * width])
+
+    @with_connection
+    def flush(self) -> None:
+        '''write all samples in the ring buffer to the samples table
+        in one batch, and empty the ring buffer'''
+        if self._pending:
+            self.con.executemany(self.insert_query, self._rows())
+        self._pending = 0
+
+    def finish(self, stats_id: int) -> None:
+        '''stop sampling, flush the ring buffer, and link all of this
+        game's samples to the row of the stats table with id stats_id'''
+        self.stop()
+        self.flush()
+        self._link(stats_id)
+
+    @with_connection
+    def _link(self, stats_id: int) -> None:
+        self.con.execute(
+            "UPDATE samples SET stats_id = ? WHERE game = ? AND stats_id IS NULL",
+            (stats_id, self._game)
+        )
@@ -0,0 +1,303 @@
+'''
+benchmarks of turtlestats storage layouts.
+Run with `python -m turtlestats.tests.benchmark`
+'''
+import datetime
+import os
+import random
+import sqlite3
+import tempfile
+import time
+import timeit
+
+from turtlestats import profiles
+from turtlestats.query import compile_select
+from turtlestats.stats import CREATE_INDEXES, StatsHolder
+from turtlestats.telemetry import TelemetryRecorder
+from turtlestats.utils import adapt_day, convert_day
+
+NUM_ROWS = 200_000
+NUM_DAYS = 1000
+REPEATS = 50
+FIRST_DAY = datetime.date(2020, 1, 1)
+USERS = ['mjo', 'fnron', 'bozar', 'norgurno', 'anoru', 'c2c']
+
+# the layout used before turtlestats 0.5.0
+TEXT_LAYOUT = '''
+CREATE TABLE stats (
+    username TEXT,
+    date TEXT,
+    score INT
+);
+'''
+
+TEXT_INDEXED_LAYOUT = TEXT_LAYOUT + "CREATE INDEX stats_date ON stats (date);"
+
+INT_LAYOUT = '''
+CREATE TABLE stats (
+    id INTEGER PRIMARY KEY,
+    username TEXT,
+    timestamp INT,
+    day INT,
+    score INT
+);
+''' + CREATE_INDEXES
+
+
+def make_rows():
+    rng = random.Random(42)
+    first_day = adapt_day(FIRST_DAY)
+    rows = []
+    for _ in range(NUM_ROWS):
+        day = first_day + rng.randrange(NUM_DAYS)
+        ms_in_day = rng.randrange(86_400_000)
+        rows.append((rng.choice(USERS), day, day * 86_400_000 + ms_in_day,
+                     rng.randrange(1000)))
+    return rows
+
+
+def make_db(dirname, name, layout, insert, rows):
+    dbname = os.path.join(dirname, name)
+    con = sqlite3.connect(dbname)
+    con.executescript(layout)
+    con.executemany(insert, rows)
+    con.commit()
+    return con
+
+
+def bench(con, query, params) -> float:
+    '''mean milliseconds per execution of query'''
+    total = timeit.timeit(lambda: con.execute(query, params).fetchall(),
+                          number=REPEATS)
+    return total / REPEATS * 1000
+
+
+def bench_dates():
+    rows = make_rows()
+    day = adapt_day(FIRST_DAY) + NUM_DAYS // 2
+    date = str(FIRST_DAY + datetime.timedelta(NUM_DAYS // 2))
+    end_date = str(FIRST_DAY + datetime.timedelta(NUM_DAYS // 2 + 30))
+    with tempfile.TemporaryDirectory() as dirname:
+        text_rows = [(user, day, score) for user, day, _, score in rows]
+        text_insert = "INSERT INTO stats VALUES (?, date(? * 86400, 'unixepoch'), ?)"
+        text_con = make_db(dirname, 'text.sqlite', TEXT_LAYOUT,
+            text_insert, text_rows)
+        indexed_con = make_db(dirname, 'text_indexed.sqlite', TEXT_INDEXED_LAYOUT,
+            text_insert, text_rows)
+        int_con = make_db(dirname, 'int.sqlite', INT_LAYOUT,
+            "INSERT INTO stats (username, timestamp, day, score) VALUES (?, ?, ?, ?)",
+            [(user, ts, day, score) for user, day, ts, score in rows])
+        cases = [
+            ('one day',
+                (text_con, "SELECT * FROM stats WHERE date = ?", (date,)),
+                (int_con, "SELECT * FROM stats WHERE day = ?", (day,))),
+            ('30-day range',
+                (text_con, "SELECT * FROM stats WHERE date BETWEEN ? AND ?", (date, end_date)),
+                (int_con, "SELECT * FROM stats WHERE day BETWEEN ? AND ?", (day, day + 30))),
+            ('top score on one day',
+                (text_con, "SELECT * FROM stats WHERE date = ? ORDER BY score DESC LIMIT 1", (date,)),
+                (int_con, "SELECT * FROM stats WHERE day = ? ORDER BY score DESC LIMIT 1", (day,))),
+            ('best score per day',
+                (text_con, "SELECT date, MAX(score) FROM stats WHERE date > ? GROUP BY date", (date,)),
+                (int_con, "SELECT day, MAX(score) FROM stats WHERE day > ? GROUP BY day", (day,))),
+            # what display.best_score_bar does
+            ('... scanning the table',
+                (text_con, "SELECT date, MAX(score) FROM stats WHERE date > ? GROUP BY date", (date,)),
+                (int_con, "SELECT day, MAX(score) FROM stats NOT INDEXED WHERE day > ? GROUP BY day", (day,))),
+            ('best score on every day',
+                (text_con, "SELECT date, MAX(score) FROM stats GROUP BY date", ()),
+                (int_con, "SELECT day, MAX(score) FROM stats GROUP BY day", ())),
+            ('... scanning the table',
+                (text_con, "SELECT date, MAX(score) FROM stats GROUP BY date", ()),
+                (int_con, "SELECT day, MAX(score) FROM stats NOT INDEXED GROUP BY day", ())),
+        ]
+        print(f"{NUM_ROWS} rows over {NUM_DAYS} days, mean of {REPEATS} runs")
+        print(f"{'query':<24}{'TEXT date (ms)':>16}{'indexed (ms)':>16}{'INT day (ms)':>16}")
+        for name, (_, text_query, text_params), int_case in cases:
+            text_ms = bench(text_con, text_query, text_params)
+            indexed_ms = bench(indexed_con, text_query, text_params)
+            print(f"{name:<24}{text_ms:>16.3f}{indexed_ms:>16.3f}{bench(*int_case):>16.3f}")
+        sizes = [os.path.getsize(os.path.join(dirname, fname)) // 1024
+                 for fname in ('text.sqlite', 'text_indexed.sqlite', 'int.sqlite')]
+        print(f"{'file size (KB)':<24}{sizes[0]:>16}{sizes[1]:>16}{sizes[2]:>16}")
+        text_con.close()
+        indexed_con.close()
+        int_con.close()
+
+
+class IdleScreen:
+    '''holds ontimer callbacks until the benchmark runs them
+    between "frames"'''
+    def __init__(self):
+        self.timers = []
+
+    def ontimer(self, fun, t=0):
+        self.timers.append(fun)
+
+
+class Scoreboard:
+    def __init__(self):
+        self.score = 0
+        self.level = 1
+        self.distance = 0.0
+        self.alive = True
+        self.screen = IdleScreen()
+
+
+TELEMETRY_STATS = {'score': int, 'level': int, 'distance': float, 'alive': bool}
+NUM_SAMPLES = 100_000
+
+
+def bench_telemetry():
+    with tempfile.TemporaryDirectory() as dirname:
+        scoreboard = Scoreboard()
+        screen = scoreboard.screen
+        holder = StatsHolder(TELEMETRY_STATS, scoreboard, dirname)
+        print(f"\n{NUM_SAMPLES} telemetry samples of {len(TELEMETRY_STATS)} stats, one per frame")
+        print(f"{'recorder':<36}{'per sample (us)':>16}{'max sample (ms)':>16}{'max idle (ms)':>16}")
+        for capacity, flush_when_full in [(1024, False), (1024, True), (4096, True)]:
+            recorder = TelemetryRecorder(holder, capacity, flush_when_full=flush_when_full)
+            recorder.start()
+            total = longest_sample = longest_idle = 0.0
+            for _ in range(NUM_SAMPLES):
+                start = time.perf_counter()
+                recorder.sample()
+                elapsed = time.perf_counter() - start
+                total += elapsed
+                longest_sample = max(longest_sample, elapsed)
+                # the game's event loop between frames
+                start = time.perf_counter()
+                timers, screen.timers = screen.timers, []
+                for fun in timers:
+                    fun()
+                longest_idle = max(longest_idle, time.perf_counter() - start)
+            name = f"capacity {capacity}, " + ("idle flushes" if flush_when_full else "keep last")
+            print(f"{name:<36}{total / NUM_SAMPLES * 1e6:>16.3f}"
+                  f"{longest_sample * 1000:>16.3f}{longest_idle * 1000:>16.3f}")
+            recorder.close()
+        for capacity in (512, 1024, 2048, 4096):
+            recorder = TelemetryRecorder(holder, capacity)
+            for _ in range(capacity):
+                recorder.sample()
+            total = timeit.timeit(recorder.flush, number=1)
+            name = f"one flush of {capacity} samples (ms)"
+            print(f"{name:<36}{total * 1000:>16.3f}")
+            recorder.close()
+        print(f"{'frame at 60 fps (ms)':<36}{1000 / 60:>16.3f}")
+        holder.close()
+
+
+class QueryScoreboard:
+    def __init__(self):
+        self.score = 0
+        self.level = 1
+        self.distance = 0.0
+        self.coins = 0
+
+
+QUERY_STATS = {'score': int, 'level': int, 'distance': float, 'coins': int}
+
+
+def bench_query():
+    statnames = tuple(QUERY_STATS)
+    rng = random.Random(42)
+    with tempfile.TemporaryDirectory() as dirname:
+        hldr = StatsHolder(QUERY_STATS, QueryScoreboard(), dirname)
+        con = sqlite3.connect(hldr.dbname)
+        con.executemany("INSERT INTO stats (username, timestamp, day, "
+                        "score, level, distance, coins) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(rng.choice(USERS), ii, ii // 200, rng.randrange(1000),
+              rng.randrange(20), rng.random() * 100, rng.randrange(50))
+             for ii in range(NUM_ROWS)])
+        con.commit()
+        con.close()
+        date = convert_day(NUM_ROWS // 400)
+        def top_on_date():
+            hldr.top_by_stat_on_date(date, 'score', 3)
+        def top_on_date_reconnect():
+            # what every getter did when each call opened its own connection
+            hldr.top_by_stat_on_date(date, 'score', 3)
+            hldr.close()
+        def top_on_date_no_cache():
+            if hldr.con is None:
+                hldr.con = sqlite3.connect(hldr.dbname, cached_statements=0)
+                hldr.con.row_factory = sqlite3.Row
+            hldr.top_by_stat_on_date(date, 'score', 3)
+        def separate():
+            for statname in statnames:
+                hldr.top_by_stat(statname, 1)
+        def top_values():
+            hldr.top_values(statnames)
+        print(f"\n{NUM_ROWS} rows, StatsHolder queries")
+        print(f"{'query':<44}{'ms':>16}")
+        for name, func in [('top 3 on one day', top_on_date),
+                           ('top 3 on one day, new connection per call', top_on_date_reconnect),
+                           ('top 3 on one day, no statement cache', top_on_date_no_cache)]:
+            hldr.close()
+            func()
+            ms = timeit.timeit(func, number=1000)
+            print(f"{name:<44}{ms:>16.3f}")
+        hldr.close()
+        for name, func in [(f'top values of {len(statnames)} stats, one query each', separate),
+                           (f'top values of {len(statnames)} stats, one scan', top_values)]:
+            ms = timeit.timeit(func, number=REPEATS) / REPEATS * 1000
+            print(f"{name:<44}{ms:>16.3f}")
+        hldr.close()
+    structure = ('stats', ('*',), (('username', '='), ('day', '>=')), (),
+                 (('score', True),), True)
+    for name, func in [('compile, not memoized (us)', compile_select.__wrapped__),
+                       ('compile, memoized (us)', compile_select)]:
+        us = timeit.timeit(lambda: func(*structure), number=10_000) / 10_000 * 1e6
+        print(f"{name:<44}{us:>16.3f}")
+
+
+def bench_profiles():
+    rng = random.Random(42)
+    con = sqlite3.connect(':memory:')
+    con.row_factory = sqlite3.Row
+    con.executescript(INT_LAYOUT)
+    con.executescript(profiles.CREATE_PROFILE_TABLES)
+    con.executemany("INSERT INTO stats (username, timestamp, day, score) VALUES (?, ?, ?, ?)",
+        [(user, ts, day, score) for user, day, ts, score in make_rows()])
+    rebuild_ms = timeit.timeit(lambda: profiles.rebuild_profiles(con, ['score']),
+                               number=1) * 1000
+    def from_history():
+        # what answering "games played, average of last 10 games,
+        # longest streak" took before player profiles
+        rows = con.execute("SELECT * FROM stats WHERE username = ?", ('mjo',)).fetchall()
+        rows.sort(key=lambda row: row['timestamp'])
+        scores = [row['score'] for row in rows]
+        longest = streak = 1
+        for prev, cur in zip(rows, rows[1:]):
+            if cur['day'] == prev['day'] + 1:
+                streak += 1
+            elif cur['day'] != prev['day']:
+                streak = 1
+            longest = max(longest, streak)
+        return len(scores), sum(scores[-10:]) / 10, longest
+    def from_profile():
+        player = con.execute("SELECT * FROM players WHERE username = ?", ('mjo',)).fetchone()
+        stat_rows = con.execute("SELECT * FROM player_stats WHERE username = ?", ('mjo',)).fetchall()
+        return profiles.summarize(player, stat_rows)
+    def store():
+        profiles.store_profile(con, 'mjo', 20_000, {'score': 500})
+    print(f"\n{NUM_ROWS} rows, profile of one of {len(USERS)} players")
+    print(f"{'operation':<36}{'ms':>16}")
+    for name, func in [('summary from full history', from_history),
+                       ('summary from profile', from_profile),
+                       ('update profile in store()', store)]:
+        ms = timeit.timeit(func, number=REPEATS) / REPEATS * 1000
+        print(f"{name:<36}{ms:>16.3f}")
+    print(f"{'rebuild all profiles':<36}{rebuild_ms:>16.3f}")
+    con.close()
+
+
+def main():
+    bench_dates()
+    bench_telemetry()
+    bench_query()
+    bench_profiles()
+
+
+if __name__ == '__main__':
+    main()
@@ -9,6 +9,7 @@ import unittest
 import pyautogui as pyag
 
 from turtlestats.display import best_score_bar, top_users_bar, FIRST_UNIX_DAY
+from turtlestats.utils import adapt_day
 
 CODE_DIR = os.path.dirname(__file__)
 TEST_GAME_STARTER = os.path.join(CODE_DIR, "start_test_game.bat")
@@ -138,12 +139,11 @@ LIMIT ?
             with sqlite3.connect(STATS_DBNAME) as con:
                 con.row_factory = sqlite3.Row
                 rows = con.execute('''
-SELECT date, mx FROM 
-    (SELECT date, MAX(distance) mx 
-    FROM stats GROUP BY date)
-WHERE date > ?
-ORDER BY date''',
-                    (FIRST_UNIX_DAY,)
+SELECT date(day * 86400, 'unixepoch') date, mx FROM 
+    (SELECT day, MAX(distance) mx 
+    FROM stats WHERE day > ? GROUP BY day)
+ORDER BY day''',
+                    (adapt_day(FIRST_UNIX_DAY),)
                 ).fetchall()
         finally:
             con.close()
@@ -41,7 +41,7 @@ sb = Scoreboard()
 sb.screen.title('Turtlestats test game')
 
 
-@display_stats_in_game(sb, {'more_ups': bool, 'ups': int, 'downs': int, 'distance': float}, 'distance')
+@display_stats_in_game(sb, {'more_ups': bool, 'ups': int, 'downs': int, 'distance': float}, 'distance', 10)
 def main():
     dist_per_up = sb.screen.numinput("Distance per up", "Enter the distance traveled per press of the up key, or Cancel to accept the default of 0.5")
     sb.screen.listen()
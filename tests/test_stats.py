@@ -0,0 +1,513 @@
+'''
+unit tests of turtlestats.stats that don't need to play the test game
+'''
+import datetime
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import unittest
+
+from turtlestats import profiles
+from turtlestats.gameplay import profile_message
+from turtlestats.query import Query, compile_select
+from turtlestats.stats import StatsHolder, make_stats_db
+from turtlestats import telemetry
+from turtlestats.telemetry import TelemetryRecorder
+from turtlestats.utils import (adapt_day, convert_day, adapt_timestamp,
+    convert_timestamp)
+
+STATS = {'score': int, 'distance': float}
+
+
+class FakeScreen:
+    '''collects ontimer callbacks so that tests can run them
+    when the game would be idle'''
+    def __init__(self):
+        self.timers = []
+
+    def ontimer(self, fun, t=0):
+        self.timers.append(fun)
+
+    def idle(self):
+        timers, self.timers = self.timers, []
+        for fun in timers:
+            fun()
+
+
+class FakeScoreboard:
+    '''StatsHolder only needs the scoreboard's stats,
+    so there's no need to open a turtle window'''
+    def __init__(self):
+        self.score = 0
+        self.distance = 0.0
+        self.screen = FakeScreen()
+
+
+class StatsTester(unittest.TestCase):
+    def setUp(self):
+        # keep the database out of tests/.turtlestats,
+        # which belongs to the test game
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.code_dir = self.tempdir.name
+        self.stats_dir = os.path.join(self.code_dir, '.turtlestats')
+        self.dbname = os.path.join(self.stats_dir, 'stats.sqlite')
+        self.sb = FakeScoreboard()
+        # cleanups run last-in first-out, so this runs after the
+        # connections opened by the test are closed
+        self.addCleanup(self.tempdir.cleanup)
+
+    def holder(self):
+        hldr = StatsHolder(STATS, self.sb, self.code_dir)
+        self.addCleanup(hldr.close)
+        return hldr
+
+    def recorder(self, hldr, *args, **kwargs):
+        recorder = TelemetryRecorder(hldr, *args, **kwargs)
+        self.addCleanup(recorder.close)
+        return recorder
+
+    def add_row(self, username, score, distance, when: datetime.datetime):
+        timestamp = adapt_timestamp(when)
+        with sqlite3.connect(self.dbname) as con:
+            con.execute(
+                "INSERT INTO stats (username, timestamp, day, score, distance) VALUES (?, ?, ?, ?, ?)",
+                (username, timestamp, adapt_day(when), score, distance)
+            )
+        con.close()
+
+    def test_day_and_timestamp_round_trip(self):
+        date = datetime.date(2022, 9, 13)
+        self.assertEqual(convert_day(adapt_day(date)), date)
+        self.assertEqual(adapt_day(str(date)), adapt_day(date))
+        self.assertEqual(adapt_day(datetime.date(1970, 1, 1)), 0)
+        dt = datetime.datetime(2022, 9, 13, 17, 5, 3, 250000)
+        self.assertEqual(convert_timestamp(adapt_timestamp(dt)), dt)
+
+    def test_store(self):
+        hldr = self.holder()
+        self.sb.score = 5
+        self.sb.distance = 2.5
+        hldr.store('mjo')
+        rows = hldr.all()
+        self.assertEqual(len(rows), 1)
+        row = rows[0]
+        self.assertEqual(row['username'], 'mjo')
+        self.assertEqual(row['score'], 5)
+        self.assertEqual(convert_day(row['day']),
+                         convert_timestamp(row['timestamp']).date())
+        today = datetime.date.today()
+        self.assertEqual(len(hldr.all_on_date(today)), 1)
+        self.assertEqual(hldr.top_by_stat_on_date(today, 'score')[0]['score'], 5)
+
+    def test_between(self):
+        hldr = self.holder()
+        self.add_row('mjo', 1, 1.0, datetime.datetime(2022, 9, 10, 8, 0))
+        self.add_row('fnron', 2, 2.0, datetime.datetime(2022, 9, 11, 23, 59))
+        self.add_row('mjo', 3, 3.0, datetime.datetime(2022, 9, 12, 0, 1))
+        self.add_row('bozar', 4, 4.0, datetime.datetime(2022, 9, 13, 12, 0))
+        rows = hldr.between(datetime.date(2022, 9, 11), datetime.date(2022, 9, 12))
+        self.assertEqual([row['score'] for row in rows], [2, 3])
+        rows = hldr.between(datetime.datetime(2022, 9, 11, 12, 0),
+                            datetime.datetime(2022, 9, 13, 0, 0))
+        self.assertEqual([row['score'] for row in rows], [2, 3])
+        with self.assertRaises(TypeError):
+            hldr.between(datetime.date(2022, 9, 11), datetime.datetime(2022, 9, 12))
+        plan = hldr.execute("EXPLAIN QUERY PLAN SELECT * FROM stats WHERE day BETWEEN 1 AND 2")
+        self.assertIn('stats_day', plan[0]['detail'])
+
+    def test_migrate_text_dates(self):
+        os.makedirs(self.stats_dir, exist_ok=True)
+        con = sqlite3.connect(self.dbname)
+        try:
+            con.executescript('''
+CREATE TABLE stats (
+    username TEXT,
+    date TEXT,
+    score INT,
+    distance REAL
+);
+INSERT INTO stats VALUES ('mjo', '2022-09-11', 10, 1.5);
+INSERT INTO stats VALUES ('fnron', '2022-09-12', 7, 3.5);
+            ''')
+        finally:
+            con.close()
+        hldr = self.holder()
+        rows = hldr.all()
+        self.assertEqual(rows[0].keys(), ['id', 'username', 'timestamp', 'day', 'score', 'distance'])
+        self.assertEqual([convert_day(row['day']) for row in rows],
+            [datetime.date(2022, 9, 11), datetime.date(2022, 9, 12)])
+        self.assertEqual(convert_timestamp(rows[1]['timestamp']),
+                         datetime.datetime(2022, 9, 12))
+        self.assertEqual(rows[1]['distance'], 3.5)
+        self.assertEqual([row['id'] for row in rows], [1, 2])
+        self.assertEqual(len(hldr.all_on_date(datetime.date(2022, 9, 12))), 1)
+        # migrating is a no-op the second time around
+        make_stats_db(STATS, self.dbname)
+        self.assertEqual(len(hldr.all()), 2)
+
+    def play(self, recorder, num_samples):
+        recorder.start()
+        for ii in range(num_samples):
+            self.sb.score = ii
+            self.sb.distance = ii / 2
+            recorder.sample()
+            # the end of a frame
+            self.sb.screen.idle()
+
+    def test_telemetry_batched_flush(self):
+        hldr = self.holder()
+        recorder = self.recorder(hldr, capacity=4, flush_when_full=True)
+        recorder.start()
+        recorder.sample()
+        recorder.sample()
+        # the ring buffer is half full, but sample() doesn't write;
+        # the flush waits until the game is idle
+        self.assertEqual(len(hldr.execute("SELECT * FROM samples")), 0)
+        self.assertEqual(len(self.sb.screen.timers), 1)
+        recorder.sample()
+        self.assertEqual(len(self.sb.screen.timers), 1)
+        self.sb.screen.idle()
+        self.assertEqual(len(recorder), 0)
+        self.assertEqual(len(hldr.execute("SELECT * FROM samples")), 3)
+        self.play(recorder, 10)
+        # flushed every other frame, and nothing is left in memory
+        self.assertEqual(len(hldr.fetch("SELECT * FROM samples WHERE game = ?",
+                                          (recorder._game,))), 10)
+        self.assertEqual(len(recorder), 0)
+        stats_id = hldr.store('mjo')
+        recorder.finish(stats_id)
+        self.assertEqual(len(recorder), 0)
+        samples = hldr.samples(stats_id)
+        self.assertEqual([row['score'] for row in samples], list(range(10)))
+        self.assertEqual(samples[-1]['distance'], 4.5)
+        # a second game's samples are linked to its own row
+        self.play(recorder, 3)
+        other_id = hldr.store('fnron')
+        recorder.finish(other_id)
+        self.assertEqual(len(hldr.samples(other_id)), 3)
+        self.assertEqual(len(hldr.samples(stats_id)), 10)
+
+    def test_telemetry_keep_last(self):
+        hldr = self.holder()
+        recorder = self.recorder(hldr, capacity=4)
+        self.play(recorder, 10)
+        self.assertEqual(self.sb.screen.timers, [])
+        self.assertEqual(len(hldr.execute("SELECT * FROM samples")), 0)
+        stats_id = hldr.store('mjo')
+        recorder.finish(stats_id)
+        samples = hldr.samples(stats_id)
+        self.assertEqual([row['score'] for row in samples], [6, 7, 8, 9])
+
+    def test_telemetry_none_stat(self):
+        hldr = self.holder()
+        recorder = self.recorder(hldr, interval=10)
+        self.sb.distance = None
+        recorder.start()
+        # the timer keeps going after a sample with a stat that's None
+        self.sb.screen.idle()
+        self.assertEqual(len(self.sb.screen.timers), 1)
+        recorder.stop()
+        stats_id = hldr.store('mjo')
+        recorder.finish(stats_id)
+        samples = hldr.samples(stats_id)
+        self.assertEqual([row['distance'] for row in samples], [None, None])
+        self.assertEqual([row['score'] for row in samples], [0, 0])
+
+    def test_telemetry_restart_one_timer(self):
+        hldr = self.holder()
+        recorder = self.recorder(hldr, interval=10)
+        recorder.start()
+        recorder.stop()
+        # restarted before the first game's timer went off
+        recorder.start()
+        for ii in range(3):
+            self.sb.screen.idle()
+        # one sample when the game started and one per tick,
+        # not two per tick
+        self.assertEqual(len(recorder), 4)
+        self.assertEqual(len(self.sb.screen.timers), 1)
+
+    def test_migrate_without_id(self):
+        # the layout with integer timestamps but only an implicit rowid
+        os.makedirs(self.stats_dir, exist_ok=True)
+        con = sqlite3.connect(self.dbname)
+        try:
+            con.executescript('''
+CREATE TABLE stats (
+    username TEXT,
+    timestamp INT,
+    day INT,
+    score INT,
+    distance REAL
+);
+INSERT INTO stats VALUES ('mjo', 1000, 0, 10, 1.5);
+INSERT INTO stats VALUES ('fnron', 2000, 0, 7, 3.5);
+INSERT INTO stats VALUES ('bozar', 3000, 0, 4, 0.5);
+DELETE FROM stats WHERE username = 'fnron';
+            ''')
+        finally:
+            con.close()
+        hldr = self.holder()
+        rows = hldr.all()
+        self.assertEqual([(row['id'], row['username'], row['timestamp']) for row in rows],
+                         [(1, 'mjo', 1000), (3, 'bozar', 3000)])
+
+    def test_telemetry_unfinished_game_not_claimed(self):
+        hldr = self.holder()
+        recorder = self.recorder(hldr, capacity=2, flush_when_full=True)
+        self.play(recorder, 5)
+        # the game crashed, so finish() was never called
+        self.play(recorder, 1)
+        stats_id = hldr.store('mjo')
+        recorder.finish(stats_id)
+        self.assertEqual(len(hldr.samples(stats_id)), 1)
+        # the crashed game's flushed samples are left alone until they're stale
+        unlinked = hldr.execute("SELECT * FROM samples WHERE stats_id IS NULL")
+        self.assertEqual(len(unlinked), 5)
+        hldr.execute(f"UPDATE samples SET timestamp = timestamp - {telemetry.STALE_UNFINISHED_MS + 1}")
+        self.play(recorder, 1)
+        # only the sample of the game that just started is left
+        unlinked = hldr.execute("SELECT * FROM samples WHERE stats_id IS NULL")
+        self.assertEqual([row['game'] for row in unlinked], [recorder._game])
+
+    def test_telemetry_concurrent_games(self):
+        hldr = self.holder()
+        first = self.recorder(hldr, capacity=2, flush_when_full=True)
+        second = self.recorder(hldr, capacity=2, flush_when_full=True)
+        first.start()
+        second.start()
+        for ii in range(5):
+            first.sample()
+            second.sample()
+            self.sb.screen.idle()
+            second.sample()
+            self.sb.screen.idle()
+        second_id = hldr.store('fnron')
+        second.finish(second_id)
+        first_id = hldr.store('mjo')
+        first.finish(first_id)
+        self.assertEqual(len(hldr.samples(first_id)), 5)
+        self.assertEqual(len(hldr.samples(second_id)), 10)
+
+    def test_telemetry_survives_vacuum(self):
+        hldr = self.holder()
+        recorder = self.recorder(hldr)
+        ids = []
+        for num_samples in [1, 2, 3]:
+            self.play(recorder, num_samples)
+            ids.append(hldr.store('mjo'))
+            recorder.finish(ids[-1])
+        hldr.execute(f"DELETE FROM stats WHERE id = {ids[0]}")
+        hldr.execute("VACUUM")
+        self.assertEqual([row['id'] for row in hldr.all()], ids[1:])
+        self.assertEqual(len(hldr.samples(ids[1])), 2)
+        self.assertEqual(len(hldr.samples(ids[2])), 3)
+
+    def add_games(self):
+        self.add_row('mjo', 10, 1.0, datetime.datetime(2022, 9, 10, 8, 0))
+        self.add_row('fnron', 7, 9.5, datetime.datetime(2022, 9, 10, 9, 0))
+        self.add_row('mjo', 3, 3.0, datetime.datetime(2022, 9, 11, 12, 0))
+        self.add_row('bozar', 12, 2.0, datetime.datetime(2022, 9, 12, 12, 0))
+        self.add_row('mjo', 8, 6.0, datetime.datetime(2022, 9, 12, 13, 0))
+
+    def test_query_compile(self):
+        query = Query(STATS).by_user('mjo').where('score', '>=', 5).order_by('score').limit(2)
+        self.assertEqual(query.compile(), (
+            "SELECT * FROM stats WHERE username = ? AND score >= ? ORDER BY score DESC LIMIT ?",
+            ('mjo', 5, 2)))
+        # the same structure with different values reuses the compiled text
+        hits = compile_select.cache_info().hits
+        other = Query(STATS).by_user('fnron').where('score', '>=', 1).order_by('score').limit(9)
+        self.assertIs(other.compile()[0], query.compile()[0])
+        self.assertGreater(compile_select.cache_info().hits, hits)
+        self.assertEqual(Query(STATS).scan().group_by('day').aggregate('MAX', 'score').compile(), (
+            "SELECT day, MAX(score) AS max_score FROM stats NOT INDEXED GROUP BY day", ()))
+        for bad in [lambda q: q.order_by('score; DROP TABLE stats'),
+                    lambda q: q.where('level', '=', 1),
+                    lambda q: q.where('score', 'LIKE', 1),
+                    lambda q: q.aggregate('MAX', 'username'),
+                    lambda q: q.aggregate('MEDIAN', 'score'),
+                    lambda q: q.aggregate('MAX', 'score', 'mx FROM stats')]:
+            with self.subTest(), self.assertRaises(ValueError):
+                bad(Query(STATS))
+
+    def test_query_fetch(self):
+        hldr = self.holder()
+        self.add_games()
+        rows = (hldr.query().by_user('mjo')
+            .between(datetime.date(2022, 9, 10), datetime.date(2022, 9, 11))
+            .where('distance', '>', 0.5)
+            .order_by('score').fetch())
+        self.assertEqual([row['score'] for row in rows], [10, 3])
+        rows = (hldr.query().group_by('username')
+            .aggregate('MAX', 'score', 'mx').aggregate('COUNT', 'score')
+            .order_by('mx').fetch())
+        self.assertEqual([tuple(row) for row in rows],
+            [('bozar', 12, 1), ('mjo', 10, 3), ('fnron', 7, 1)])
+        self.assertEqual(hldr.top_by_stat_by_user('mjo', 'distance')[0]['distance'], 6.0)
+        first = hldr.first_per_date('score', datetime.date(2022, 9, 11))
+        self.assertEqual(tuple(first[0]),
+            ('mjo', adapt_day(datetime.date(2022, 9, 11)), 3))
+
+    def test_connection_kept_open(self):
+        hldr = self.holder()
+        self.add_games()
+        hldr.top_by_stat('score')
+        con = hldr.con
+        self.assertIsNotNone(con)
+        hldr.top_by_stat_by_user('mjo', 'score')
+        hldr.all_on_date(datetime.date(2022, 9, 10))
+        self.assertIs(hldr.con, con)
+        hldr.close()
+        self.assertIsNone(hldr.con)
+        # reopened on demand
+        self.assertEqual(hldr.top_by_stat('score')[0]['score'], 12)
+
+    def test_query_dates(self):
+        hldr = self.holder()
+        self.add_games()
+        query = hldr.query()
+        rows = query.where('day', '>=', datetime.date(2022, 9, 12)).fetch()
+        self.assertEqual([row['score'] for row in rows], [12, 8])
+        rows = query.where('timestamp', '<', datetime.date(2022, 9, 11)).fetch()
+        self.assertEqual([row['score'] for row in rows], [10, 7])
+        rows = query.where('timestamp', '>', datetime.datetime(2022, 9, 12, 12, 30)).fetch()
+        self.assertEqual([row['score'] for row in rows], [8])
+        # ISO format strings work like the dates they stand for,
+        # as they did when days were stored as TEXT
+        rows = query.where('day', '>=', '2022-09-12').fetch()
+        self.assertEqual([row['score'] for row in rows], [12, 8])
+        self.assertEqual([row['score'] for row in hldr.all_on_date('2022-09-11')], [3])
+        rows = query.where('timestamp', '>', '2022-09-12 12:30').fetch()
+        self.assertEqual([row['score'] for row in rows], [8])
+        rows = query.where('timestamp', '<', '2022-09-11').fetch()
+        self.assertEqual([row['score'] for row in rows], [10, 7])
+        with self.assertRaises(TypeError):
+            query.where('timestamp', '>=', 1.5)
+
+    def test_top_values(self):
+        hldr = self.holder()
+        self.add_games()
+        self.assertEqual(hldr.query().by_user('mjo').top_values(['score', 'distance']),
+                         {'score': 10, 'distance': 6.0})
+        self.assertEqual(hldr.top_values(['score', 'distance']),
+                         {'score': 12, 'distance': 9.5})
+
+    def profile_tables(self, hldr):
+        return (hldr.execute("SELECT * FROM players ORDER BY username"),
+                hldr.execute("SELECT * FROM player_stats ORDER BY username, stat"))
+
+    def test_profile_matches_rebuild(self):
+        hldr = self.holder()
+        rng = random.Random(29)
+        day = adapt_day(datetime.date(2022, 9, 1))
+        timestamp = 0
+        games = {}
+        for _ in range(300):
+            username = rng.choice(['mjo', 'fnron', 'bozar'])
+            # mostly play again the same day or the next, sometimes skip days
+            day += rng.choice([0, 0, 1, 1, 1, 3])
+            timestamp = max(timestamp + 1, day * 86_400_000)
+            score, distance = rng.randrange(100), rng.random() * 10
+            games.setdefault(username, []).append((day, score))
+            with sqlite3.connect(self.dbname) as con:
+                con.execute("INSERT INTO stats (username, timestamp, day, score, distance) VALUES (?, ?, ?, ?, ?)",
+                    (username, timestamp, day, score, distance))
+                profiles.store_profile(con, username, day,
+                    {'score': score, 'distance': distance})
+            con.close()
+        incremental = self.profile_tables(hldr)
+        hldr.rebuild_profiles()
+        rebuilt = self.profile_tables(hldr)
+        for inc_rows, reb_rows in zip(incremental, rebuilt):
+            self.assertEqual([tuple(row) for row in inc_rows],
+                             [tuple(row) for row in reb_rows])
+        # check the summary against a brute-force recomputation
+        profile = hldr.player('mjo')
+        days = [day for day, _ in games['mjo']]
+        scores = [score for _, score in games['mjo']]
+        self.assertEqual(profile['games'], len(scores))
+        streaks = [1]
+        for prev, cur in zip(days, days[1:]):
+            if cur == prev + 1:
+                streaks.append(streaks[-1] + 1)
+            else:
+                streaks.append(streaks[-1] if cur == prev else 1)
+        # the games were long ago, so the streak has ended by now,
+        # but it's stored as of the last game
+        self.assertEqual(profile['current_streak'], 0)
+        stored = hldr.execute("SELECT current_streak FROM players WHERE username = 'mjo'")
+        self.assertEqual(stored[0][0], streaks[-1])
+        self.assertEqual(profile['longest_streak'], max(streaks))
+        score = profile['stats']['score']
+        self.assertAlmostEqual(score['mean'], statistics.fmean(scores))
+        self.assertAlmostEqual(score['std'], statistics.pstdev(scores))
+        self.assertEqual(score['best'], max(scores))
+        self.assertEqual(score['recent'], scores[-profiles.RECENT_GAMES:])
+        ewma = scores[0]
+        for value in scores[1:]:
+            ewma = profiles.EWMA_ALPHA * value + (1 - profiles.EWMA_ALPHA) * ewma
+        self.assertAlmostEqual(score['ewma'], ewma)
+
+    def test_profile_store(self):
+        hldr = self.holder()
+        self.assertIsNone(hldr.player('mjo'))
+        for score in [5, 9, 7, 12]:
+            self.sb.score = score
+            hldr.store('mjo')
+        profile = hldr.player('mjo')
+        self.assertEqual(profile['games'], 4)
+        self.assertEqual(profile['current_streak'], 1)
+        self.assertEqual(profile['stats']['score']['improvement'], 3)
+        self.assertEqual(profile['stats']['score']['recent_mean'], 8.25)
+        incremental = self.profile_tables(hldr)
+        hldr.rebuild_profiles()
+        self.assertEqual([list(map(tuple, rows)) for rows in incremental],
+                         [list(map(tuple, rows)) for rows in self.profile_tables(hldr)])
+
+    def test_profile_message_tie(self):
+        hldr = self.holder()
+        messages = []
+        for score in [5, 9, 9]:
+            before = hldr.player('mjo')
+            previous_best = before and before['stats']['score']['best']
+            self.sb.score = score
+            hldr.store('mjo')
+            messages.append(profile_message(hldr.player('mjo'), 'score',
+                                            score, previous_best))
+        self.assertNotIn("beat", messages[0])
+        self.assertIn("You beat your previous best by 4!", messages[1])
+        # tying your best isn't beating it
+        self.assertNotIn("beat", messages[2])
+        self.assertIn("Games played: 3.", messages[2])
+
+    def test_profile_streak_ended(self):
+        hldr = self.holder()
+        for score in [5, 9]:
+            self.sb.score = score
+            hldr.store('mjo')
+        self.assertEqual(hldr.player('mjo')['current_streak'], 1)
+        # the last game was yesterday, so the streak can still go on
+        hldr.execute("UPDATE players SET last_day = last_day - 1")
+        self.assertEqual(hldr.player('mjo')['current_streak'], 1)
+        # a day was skipped since the last game
+        hldr.execute("UPDATE players SET last_day = last_day - 2")
+        profile = hldr.player('mjo')
+        self.assertEqual(profile['current_streak'], 0)
+        self.assertEqual(profile['longest_streak'], 1)
+
+    def test_profile_built_for_old_db(self):
+        os.makedirs(self.stats_dir, exist_ok=True)
+        make_stats_db(STATS, self.dbname)
+        self.add_games()
+        hldr = self.holder()
+        profile = hldr.player('mjo')
+        self.assertEqual(profile['games'], 3)
+        self.assertEqual(profile['stats']['score']['best'], 10)
+        self.assertEqual(profile['longest_streak'], 3)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
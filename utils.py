@@ -1,4 +1,9 @@
 '''miscellaneous utility functions'''
+import datetime
+import time
+from typing import Union
+
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
 
 def sqlite_typename(typ: type) -> str:
     if issubclass(typ, int):
@@ -7,4 +12,36 @@ def sqlite_typename(typ: type) -> str:
         return "REAL"
     elif typ == str:
         return "TEXT"
-    raise ValueError(None, "types for stats must be str, bool, int, or float")
\ No newline at end of file
+    raise ValueError(None, "types for stats must be str, bool, int, or float")
+
+def now_timestamp() -> int:
+    '''the current time in integer milliseconds since the Unix epoch'''
+    return time.time_ns() // 1_000_000
+
+def adapt_timestamp(dt: datetime.datetime) -> int:
+    '''convert a datetime to integer milliseconds since the Unix epoch
+    (the format of the timestamp column).
+    Naive datetimes are assumed to be in local time.'''
+    return round(dt.timestamp() * 1000)
+
+def convert_timestamp(timestamp: int) -> datetime.datetime:
+    '''convert integer milliseconds since the Unix epoch
+    to a local naive datetime'''
+    return datetime.datetime.fromtimestamp(timestamp / 1000)
+
+def adapt_day(date: Union[datetime.date, str]) -> int:
+    '''convert a date (or a datetime, or a YYYY-MM-DD string)
+    to the number of days since 1970-01-01 (the format of the day column)'''
+    if isinstance(date, str):
+        date = datetime.date.fromisoformat(date)
+    elif isinstance(date, datetime.datetime):
+        date = date.date()
+    return date.toordinal() - EPOCH_ORDINAL
+
+def convert_day(day: int) -> datetime.date:
+    '''convert a number of days since 1970-01-01 to a date'''
+    return datetime.date.fromordinal(day + EPOCH_ORDINAL)
+
+def day_of_timestamp(timestamp: int) -> int:
+    '''the (local) day number on which a timestamp falls'''
+    return adapt_day(convert_timestamp(timestamp))